@@ -1,107 +1,366 @@
 from __future__ import annotations
 
 import argparse
-import ast
+import concurrent.futures
+import dataclasses
 import functools
+import http.client
 import json
+import operator
 import re
+import ssl
 import subprocess
+import threading
+import time
 import urllib.error
 import urllib.parse
-import urllib.request
+from typing import Any
+from typing import Callable
+from typing import cast
 from typing import Mapping
 from typing import NamedTuple
+from typing import TypeVar
 
 ARCHS = frozenset(('amd64', 'arm64', 'arm64/v8'))
 
 LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
 SINGLE = 'application/vnd.docker.distribution.manifest.v2+json'
 INDEX = 'application/vnd.oci.image.index.v1+json'
+OCI_SINGLE = 'application/vnd.oci.image.manifest.v1+json'
+# annoyingly, even if we only "Accept" the list, docker.io will send us a
+# single manifest
+ACCEPT = f'{LIST}, {INDEX}, {SINGLE};q=.9, {OCI_SINGLE};q=.9'
+
+TFunc = TypeVar('TFunc', bound=Callable[..., Any])
+
+# the auth challenges of the registries we use, so we can skip probing them
+REALMS = {
+    'registry-1.docker.io': (
+        'https://auth.docker.io/token', 'registry.docker.io',
+    ),
+    'ghcr.io': ('https://ghcr.io/token', 'ghcr.io'),
+}
+
+# key="quoted \"string\"" or key=token (RFC 7235)
+AUTH_PARAM = re.compile(r'(\w+)=(?:"((?:[^"\\]|\\.)*)"|([^\s,"]+))')
+AUTH_ESCAPE = re.compile(r'\\(.)')
+
+REDIRECTS = frozenset((301, 302, 303, 307, 308))
+# docker hub in particular is flaky -- retry errors with an increasing backoff
+RETRIES = 3
+RETRY_STATUSES = frozenset((500, 502, 503, 504))
+BACKOFF = .3
+
+# loading the CA bundle is slow, share one context between all connections
+_SSL_CONTEXT = ssl.create_default_context()
+# http.client connections are not thread safe, keep them per thread
+_CONNECTIONS = threading.local()
+
+
+class _Response(NamedTuple):
+    status: int
+    headers: http.client.HTTPMessage
+    data: bytes
+
+
+def _connection(host: str) -> http.client.HTTPSConnection:
+    try:
+        connections = _CONNECTIONS.connections
+    except AttributeError:
+        connections = _CONNECTIONS.connections = {}
+
+    try:
+        return connections[host]
+    except KeyError:
+        conn = http.client.HTTPSConnection(
+            host, timeout=30, context=_SSL_CONTEXT,
+        )
+        connections[host] = conn
+        return conn
+
+
+def _send(
+        method: str,
+        host: str,
+        path: str,
+        headers: Mapping[str, str],
+) -> _Response:
+    for attempt in range(RETRIES + 1):
+        # the first retry is immediate: usually the server just dropped our
+        # idle keep-alive connection
+        if attempt > 1:
+            time.sleep(BACKOFF * 2 ** (attempt - 1))
+
+        conn = _connection(host)
+        try:
+            conn.request(method, path, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except ssl.SSLCertVerificationError:
+            # retrying won't fix a bad certificate
+            conn.close()
+            raise
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if attempt == RETRIES:
+                raise
+        else:
+            if resp.status not in RETRY_STATUSES or attempt == RETRIES:
+                return _Response(resp.status, resp.headers, data)
+    else:
+        raise AssertionError('unreachable')
+
+
+def _request(
+        method: str,
+        url: str,
+        headers: Mapping[str, str] | None = None,
+) -> _Response:
+    req_headers = {'User-Agent': 'image-mirror', **(headers or {})}
+
+    for _ in range(5):
+        parsed = urllib.parse.urlsplit(url)
+        path = f'{parsed.path}?{parsed.query}' if parsed.query else parsed.path
+
+        resp = _send(method, parsed.netloc, path, req_headers)
+
+        if resp.status in REDIRECTS:
+            url = urllib.parse.urljoin(url, resp.headers['Location'])
+            # don't leak our credentials to a CDN
+            if urllib.parse.urlsplit(url).netloc != parsed.netloc:
+                req_headers.pop('Authorization', None)
+            continue
+
+        return resp
+    else:
+        raise AssertionError(f'too many redirects: {url}')
+
+
+def _raise_for_status(url: str, resp: _Response) -> _Response:
+    if resp.status >= 400:
+        raise urllib.error.HTTPError(
+            url, resp.status, http.client.responses[resp.status],
+            resp.headers, None,
+        )
+    return resp
+
+
+def _get(url: str, headers: Mapping[str, str] | None = None) -> _Response:
+    return _raise_for_status(url, _request('GET', url, headers))
+
+
+def _head(url: str, headers: Mapping[str, str] | None = None) -> _Response:
+    return _raise_for_status(url, _request('HEAD', url, headers))
+
+
+def _memoize(func: TFunc) -> TFunc:
+    # like functools.lru_cache, but concurrent calls with the same arguments
+    # wait for the first one rather than all missing the cache at once.
+    # positional arguments only -- the decorated function keeps its signature
+    # for mypy, but keyword arguments are rejected at runtime
+    cached = functools.lru_cache(maxsize=None)(func)
+    guard = threading.Lock()
+    locks: dict[tuple[Any, ...], threading.Lock] = {}
+
+    @functools.wraps(func)
+    def memoized(*args: Any) -> Any:
+        with guard:
+            lock = locks.setdefault(args, threading.Lock())
+        with lock:
+            return cached(*args)
+
+    return cast(TFunc, memoized)
 
 
 def _parse_auth_header(s: str) -> dict[str, str]:
     bearer = 'Bearer '
     assert s.startswith(bearer)
-    s = s[len(bearer):]
-
-    ret = {}
-    for part in s.split(','):
-        k, _, v = part.partition('=')
-        v = ast.literal_eval(v)
-        ret[k] = v
-    return ret
+    return {
+        k: AUTH_ESCAPE.sub(r'\1', quoted) if quoted else token
+        for k, quoted, token in AUTH_PARAM.findall(s, len(bearer))
+    }
 
 
-@functools.lru_cache(maxsize=None)
+@_memoize
 def _auth_challenge(registry: str) -> tuple[str, Mapping[str, str]]:
-    try:
-        urllib.request.urlopen(f'https://{registry}/v2/', timeout=5)
-    except urllib.error.HTTPError as e:
-        if e.code != 401 or 'www-authenticate' not in e.headers:
-            raise
+    scope = 'repository:user/image:pull'
 
-        auth = _parse_auth_header(e.headers['www-authenticate'])
+    if registry in REALMS:
+        realm, service = REALMS[registry]
+        return realm, {'service': service, 'scope': scope}
+
+    resp = _request('HEAD', f'https://{registry}/v2/')
+    if resp.status == 401 and 'www-authenticate' in resp.headers:
+        auth = _parse_auth_header(resp.headers['www-authenticate'])
     else:
         raise AssertionError(f'expected auth challenge: {registry}')
+    assert 'realm' in auth, f'no realm in auth challenge: {registry}'
 
     realm = auth.pop('realm')
-    auth.setdefault('scope', 'repository:user/image:pull')
+    auth.setdefault('scope', scope)
 
     return realm, auth
 
 
-def _digests(registry: str, image: str, tag: str) -> list[tuple[str, str]]:
+@_memoize
+def _token(registry: str, image: str) -> str:
     realm, auth = _auth_challenge(registry)
     auth = {k: v.replace('user/image', image) for k, v in auth.items()}
 
     auth_url = f'{realm}?{urllib.parse.urlencode(auth)}'
-    token = json.load(urllib.request.urlopen(auth_url))['token']
+    return json.loads(_get(auth_url).data)['token']
+
 
-    req = urllib.request.Request(
+@_memoize
+def _digests(
+        registry: str,
+        image: str,
+        tag: str,
+) -> tuple[tuple[str, str], ...]:
+    token = _token(registry, image)
+
+    resp = _get(
         f'https://{registry}/v2/{image}/manifests/{tag}',
-        headers={
-            'Authorization': f'Bearer {token}',
-            # annoyingly, even if we only "Accept" the list, docker.io will
-            # send us a single manifest
-            'Accept': f'{LIST}, {INDEX}, {SINGLE};q=.9',
-        },
+        headers={'Authorization': f'Bearer {token}', 'Accept': ACCEPT},
     )
-    resp = urllib.request.urlopen(req)
-    ret = json.load(resp)
+    ret = json.loads(resp.data)
     if resp.headers['Content-Type'] in {LIST, INDEX}:
-        return [
+        return tuple(
             (manifest['platform']['architecture'], manifest['digest'])
             for manifest in ret['manifests']
-        ]
-    elif resp.headers['Content-Type'] == SINGLE:
+            if manifest['platform']['architecture'] in ARCHS
+        )
+    elif resp.headers['Content-Type'] in {SINGLE, OCI_SINGLE}:
         blob = ret['config']['digest']
-        req = urllib.request.Request(
+        blob_resp = _get(
             f'https://{registry}/v2/{image}/blobs/{blob}',
             headers={'Authorization': f'Bearer {token}'},
         )
-        ret = json.load(urllib.request.urlopen(req))
-        return [(ret['architecture'], resp.headers['Docker-Content-Digest'])]
+        arch = json.loads(blob_resp.data)['architecture']
+        if arch in ARCHS:
+            return ((arch, resp.headers['Docker-Content-Digest']),)
+        else:
+            return ()
     else:
         raise NotImplementedError(resp.headers['Content-Type'])
 
 
-class Image(NamedTuple):
+def _manifest_digest(registry: str, image: str, tag: str) -> str:
+    resp = _head(
+        f'https://{registry}/v2/{image}/manifests/{tag}',
+        headers={
+            'Authorization': f'Bearer {_token(registry, image)}',
+            'Accept': ACCEPT,
+        },
+    )
+    return resp.headers['Docker-Content-Digest']
+
+
+@dataclasses.dataclass(frozen=True)
+class Image:
     registry: str
     source: str
     tag: str
     digests: tuple[str, ...] = ()
 
-    @property
+    @functools.cached_property
     def display(self) -> str:
         return f'{self.registry}/{self.source}:{self.tag}'
 
+    @functools.cached_property
+    def dest_image(self) -> str:
+        return f'getsentry/image-mirror-{self.source.replace("/", "-")}'
+
+    @functools.cached_property
+    def manifest_ref(self) -> str:
+        return f'ghcr.io/{self.dest_image}:{self.tag}'
+
     def update(self) -> Image:
         digests = tuple(
             digest
-            for arch, digest in _digests(self.registry, self.source, self.tag)
-            if arch in ARCHS
+            for _, digest in _digests(self.registry, self.source, self.tag)
         )
-        return self._replace(digests=digests)
+        return dataclasses.replace(self, digests=digests)
+
+
+def _update(img: Image) -> Image:
+    print(f'updating {img.display}...')
+    return img.update()
+
+
+def _missing_digests(img: Image, *, legacy: bool) -> frozenset[str]:
+    try:
+        # _sync copies a single digest as-is (--prefer-index=false), so the
+        # tag's own digest usually tells us it is up to date without reading
+        # any manifest / blob.  tags pushed by `docker manifest create`
+        # (--legacy, and mirrors made before that flag) wrap it in a list
+        # instead -- for those fall through to comparing the list's entries
+        if len(img.digests) == 1 and not legacy:
+            digest = _manifest_digest('ghcr.io', img.dest_image, img.tag)
+            if digest in img.digests:
+                return frozenset()
+
+        target_digest_info = _digests('ghcr.io', img.dest_image, img.tag)
+    except urllib.error.HTTPError as e:
+        if e.code not in {403, 404}:
+            raise
+        else:
+            target_digest_info = ()
+
+    target_digests = {digest for _, digest in target_digest_info}
+    # the common case: everything is already mirrored
+    if all(digest in target_digests for digest in img.digests):
+        return frozenset()
+    else:
+        return frozenset(img.digests) - target_digests
+
+
+def _noqa(line: str) -> str:
+    return line if len(line) < 80 else f'{line}  # noqa: E501'
+
+
+def _docker(*args: str) -> None:
+    # keep output from concurrent syncs from interleaving
+    subprocess.check_call(('docker', *args), stdout=subprocess.DEVNULL)
+
+
+def _sync(img: Image) -> None:
+    print(f'syncing {img.display}...')
+    # copies registry to registry (skipping blobs ghcr.io already has)
+    # without pulling anything into the local daemon
+    if len(img.digests) == 1:
+        # buildx >= 0.12 otherwise wraps a single source in a new index
+        opts: tuple[str, ...] = ('--prefer-index=false',)
+    else:
+        opts = ()
+    _docker(
+        'buildx', 'imagetools', 'create', *opts,
+        '--tag', img.manifest_ref,
+        *(f'{img.registry}/{img.source}@{digest}' for digest in img.digests),
+    )
+
+
+def _sync_legacy(img: Image, missing: frozenset[str]) -> None:
+    print(f'syncing {img.display}...')
+    manifest = img.manifest_ref
+    src_img = f'{img.registry}/{img.source}'
+
+    refs = []
+    for i, digest in enumerate(img.digests):
+        if digest in missing:
+            src = f'{src_img}@{digest}'
+            dest = f'{manifest}-digest{i}'
+
+            _docker('pull', '--quiet', src)
+            _docker('tag', src, dest)
+            _docker('push', '--quiet', dest)
+
+            refs.append(dest)
+        else:  # already in the repository, no need to copy it again
+            refs.append(f'ghcr.io/{img.dest_image}@{digest}')
+
+    _docker('manifest', 'create', manifest, *refs)
+    _docker('manifest', 'push', manifest)
 
 
 IMAGES = (
@@ -321,34 +580,36 @@ def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument('command', choices=('update', 'sync'))
     parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--legacy', action='store_true')
     args = parser.parse_args()
 
     if args.command == 'update':
-        imgs = []
-        for img in IMAGES:
-            print(f'updating {img.display}...')
-            imgs.append(img.update())
-        imgs.sort()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+            imgs = list(ex.map(_update, IMAGES))
+        imgs.sort(key=operator.attrgetter('registry', 'source', 'tag'))
 
         lines = ['IMAGES = (']
         for img in imgs:
             lines.append('    Image(')
-            for field in img._fields:
-                if field != 'digests':
-                    lines.append(f'        {field}={getattr(img, field)!r},')
+            for field in dataclasses.fields(img):
+                if field.name != 'digests':
+                    value = getattr(img, field.name)
+                    line = f'        {field.name}={value!r},'
+                    lines.append(_noqa(line))
             lines.append('        digests=(')
             for digest in img.digests:
-                lines.append(f'            {digest!r},')
+                # sha256 digests never fit on a line
+                lines.append(f'            {digest!r},  # noqa: E501')
             lines.append('        ),')
             lines.append('    ),')
         lines.append(')')
 
-        lines = [s if len(s) < 80 else f'{s}  # noqa: E501' for s in lines]
-
         with open(__file__) as f:
             src = f.read()
 
-        src = re.sub(r'IMAGES = \(\n( +.+\n)+\)', '\n'.join(lines), src)
+        start = src.index('IMAGES = (\n')
+        end = src.index('\n)\n', start) + len('\n)')
+        src = src[:start] + '\n'.join(lines) + src[end:]
 
         if args.dry_run:
             print(src)
@@ -356,41 +617,31 @@ def main() -> int:
             with open(__file__, 'w') as f:
                 f.write(src)
     elif args.command == 'sync':
-        for img in IMAGES:
-            dest_img = f'getsentry/image-mirror-{img.source.replace("/", "-")}'
-
-            try:
-                target_digest_info = _digests('ghcr.io', dest_img, img.tag)
-            except urllib.error.HTTPError as e:
-                if e.code not in {403, 404}:
-                    raise
-                else:
-                    target_digest_info = []
-
-            target_digests = [digest for _, digest in target_digest_info]
-            todo = sorted(frozenset(img.digests) - frozenset(target_digests))
-            if not todo:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as ex:
+            probe = functools.partial(_missing_digests, legacy=args.legacy)
+            probes = list(ex.map(probe, IMAGES))
+
+        todo = []
+        for img, missing in zip(IMAGES, probes):
+            if not missing:
                 continue
             elif args.dry_run:
                 print(f'would sync {img.display}...')
-                continue
             else:
-                print(f'syncing {img.display}...')
-
-            manifest = f'ghcr.io/{dest_img}:{img.tag}'
-            for i, digest in enumerate(img.digests):
-                src = f'{img.registry}/{img.source}@{digest}'
-                dest = f'{manifest}-digest{i}'
-
-                subprocess.check_call(('docker', 'pull', '--quiet', src))
-                subprocess.check_call(('docker', 'tag', src, dest))
-                subprocess.check_call(('docker', 'push', '--quiet', dest))
-
-            subprocess.check_call((
-                'docker', 'manifest', 'create', manifest,
-                *(f'{manifest}-digest{i}' for i in range(len(img.digests))),
-            ))
-            subprocess.check_call(('docker', 'manifest', 'push', manifest))
+                todo.append((img, missing))
+
+        # images are copied independently -- but only a few at a time so we
+        # don't swamp the docker daemon
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+            if args.legacy:
+                futures = [
+                    ex.submit(_sync_legacy, img, missing)
+                    for img, missing in todo
+                ]
+            else:
+                futures = [ex.submit(_sync, img) for img, _ in todo]
+            for future in futures:
+                future.result()
     else:
         raise NotImplementedError(args.command)
 